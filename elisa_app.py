@@ -1,78 +1,36 @@
-import sqlite3
-import os
-from datetime import datetime
-import pandas as pd
-
-try:
-    import gspread
-    from oauth2client.service_account import ServiceAccountCredentials
-except ImportError:
-    gspread = None
-
-DB_FILE = 'elisa.db'
-EXCEL_FILE = 'elisa.xlsx'
-GOOGLE_CREDENTIALS = 'credentials.json'
-GOOGLE_SHEET_NAME = 'ElisaData'
-
-
-def ensure_working_directory():
-    """Ensure default working directory exists and switch to it."""
-    target = os.path.join(os.path.expanduser('~'), 'projects', 'ELISA')
-    os.makedirs(target, exist_ok=True)
-    os.chdir(target)
-
-
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS plates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS wells (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            plate_id INTEGER,
-            well TEXT,
-            sample TEXT,
-            value REAL,
-            category TEXT,
-            serum TEXT,
-            normalized REAL,
-            result TEXT,
-            FOREIGN KEY(plate_id) REFERENCES plates(id)
-        )
-    ''')
-    # Ensure "category" column exists when upgrading from older versions
-    cursor.execute("PRAGMA table_info(wells)")
-    cols = [c[1] for c in cursor.fetchall()]
-    if 'category' not in cols:
-        cursor.execute('ALTER TABLE wells ADD COLUMN category TEXT')
-    if 'serum' not in cols:
-        cursor.execute('ALTER TABLE wells ADD COLUMN serum TEXT')
-    if 'normalized' not in cols:
-        cursor.execute('ALTER TABLE wells ADD COLUMN normalized REAL')
-    if 'result' not in cols:
-        cursor.execute('ALTER TABLE wells ADD COLUMN result TEXT')
-    conn.commit()
-    conn.close()
-
-
-def get_gsheet_client():
-    if gspread is None:
-        raise RuntimeError('gspread is not installed')
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS, scope)
-    client = gspread.authorize(creds)
-    return client
-
-
-def add_plate():
+import atexit
+
+from elisa_core import (
+    DB_FILE,
+    EXPORT_FORMATS,
+    GOOGLE_SHEET_NAME,
+    SQL_SELECT_WELLS,
+    WELL_COLUMNS,
+    connect,
+    ensure_working_directory,
+    get_gsheet_client,
+    init_db,
+    load_gspread,
+    read_all_plates,
+    store_plate,
+)
+
+_conn = None
+
+
+def get_connection():
+    """Return the shared database connection, opening it on first use."""
+    global _conn
+    if _conn is None:
+        _conn = connect()
+        atexit.register(_conn.close)
+    return _conn
+
+
+def add_plate(fmt=EXPORT_FORMATS[0]):
     name = input('Plate name: ').strip()
-    rows = []
+    # Keyed by well so that entering a well again replaces the earlier entry
+    rows = {}
     print('Enter well data. Leave well blank to finish.')
     while True:
         well = input('Well: ').strip()
@@ -85,38 +43,28 @@ def add_plate():
         except ValueError:
             print('Invalid value, skipping well')
             continue
-        rows.append({'well': well, 'sample': sample, 'value': value})
+        rows[well.upper()] = (well, sample, value)
 
     if not rows:
         print('No data entered.')
         return
+    rows = list(rows.values())
 
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO plates (name) VALUES (?)', (name,))
-    plate_id = cursor.lastrowid
-    cursor.executemany(
-        'INSERT INTO wells (plate_id, well, sample, value) VALUES (?, ?, ?, ?)',
-        [(plate_id, r['well'], r['sample'], r['value']) for r in rows]
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=['well', 'sample', 'value'])
+    df.insert(0, 'plate', name)
+
+    db_future, file_future, gsheet_future = store_plate(
+        get_connection(), name, ((*r, None, None) for r in rows), df, fmt, to_google=True
     )
-    conn.commit()
-    conn.close()
 
-    df = pd.DataFrame(rows)
-    df.insert(0, 'plate', name)
-    if os.path.exists(EXCEL_FILE):
-        with pd.ExcelWriter(EXCEL_FILE, mode='a', if_sheet_exists='new', engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name=name, index=False)
-    else:
-        df.to_excel(EXCEL_FILE, sheet_name=name, index=False)
-    print(f'Plate {name} saved to {EXCEL_FILE} and {DB_FILE}.')
+    db_future.result()
+    path = file_future.result()
+    print(f'Plate {name} saved to {path} and {DB_FILE}.')
 
-    if gspread:
+    if gsheet_future is not None:
         try:
-            client = get_gsheet_client()
-            sheet = client.open(GOOGLE_SHEET_NAME)
-            ws = sheet.add_worksheet(title=name, rows=str(len(df)+1), cols=str(len(df.columns)))
-            ws.update([df.columns.tolist()] + df.values.tolist())
+            gsheet_future.result()
             print(f'Plate {name} uploaded to Google Sheets ({GOOGLE_SHEET_NAME}).')
         except Exception as e:
             print('Google Sheets upload failed:', e)
@@ -125,26 +73,46 @@ def add_plate():
 
 
 def fetch_local():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query('SELECT plates.name as plate, wells.well, wells.sample, wells.value, wells.category '
-                           'FROM wells JOIN plates ON wells.plate_id = plates.id', conn)
-    conn.close()
-    print(df)
+    # A plain cursor is enough to print the rows; building a DataFrame
+    # would cost more than the query itself.
+    rows = get_connection().execute(SQL_SELECT_WELLS).fetchall()
+    print('\t'.join(WELL_COLUMNS))
+    for row in rows:
+        print('\t'.join('' if v is None else str(v) for v in row))
+
+
+def fetch_files():
+    # Reload every plate from the Parquet exports without touching the database
+    df = read_all_plates()
+    if df.empty:
+        print('No Parquet exports found.')
+        return
+    print(df.to_csv(sep='\t', index=False), end='')
 
 
 def fetch_online():
-    if not gspread:
+    if not load_gspread():
         print('gspread not installed.')
         return
+    import pandas as pd
     try:
         client = get_gsheet_client()
         sheet = client.open(GOOGLE_SHEET_NAME)
     except Exception as e:
         print('Unable to open Google Sheet:', e)
         return
-    for ws in sheet.worksheets():
-        data = ws.get_all_records()
-        df = pd.DataFrame(data)
+    worksheets = sheet.worksheets()
+    # Read every worksheet in a single values:batchGet request instead of
+    # one round-trip per plate.
+    ranges = ["'{}'".format(ws.title.replace("'", "''")) for ws in worksheets]
+    try:
+        result = sheet.values_batch_get(ranges, params={'valueRenderOption': 'UNFORMATTED_VALUE'})
+    except Exception as e:
+        print('Unable to read Google Sheet:', e)
+        return
+    for ws, value_range in zip(worksheets, result.get('valueRanges', [])):
+        values = value_range.get('values', [])
+        df = pd.DataFrame(values[1:], columns=values[0]) if values else pd.DataFrame()
         print(f'Worksheet {ws.title}:')
         print(df)
 
@@ -154,16 +122,21 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Manage ELISA results.')
     parser.add_argument('--add', action='store_true', help='Add a new plate')
     parser.add_argument('--fetch-local', action='store_true', help='Show local results')
+    parser.add_argument('--fetch-files', action='store_true', help='Show results exported as Parquet')
     parser.add_argument('--fetch-online', action='store_true', help='Show results from Google Sheets')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default=EXPORT_FORMATS[0],
+                        help='File format used when exporting a new plate')
     args = parser.parse_args()
 
     ensure_working_directory()
-    init_db()
+    init_db(get_connection())
 
     if args.add:
-        add_plate()
+        add_plate(args.format)
     elif args.fetch_local:
         fetch_local()
+    elif args.fetch_files:
+        fetch_files()
     elif args.fetch_online:
         fetch_online()
     else:
@@ -0,0 +1,331 @@
+import sqlite3
+import os
+import re
+import hashlib
+from contextlib import contextmanager
+from glob import glob
+
+DB_FILE = 'elisa.db'
+PLATES_DIR = 'plates'
+# The first format is the default: Parquet files are smaller and much faster
+# to write and reload than workbooks, so Excel is kept for explicit exports.
+EXPORT_FORMATS = ('parquet', 'xlsx')
+GOOGLE_CREDENTIALS = 'credentials.json'
+GOOGLE_SHEET_NAME = 'ElisaData'
+# Stored in PRAGMA user_version once init_db has migrated a database
+CURRENT_SCHEMA_VERSION = 1
+
+SQL_SELECT_PLATE_ID = 'SELECT id FROM plates WHERE name=?'
+SQL_INSERT_PLATE = 'INSERT INTO plates (name) VALUES (?)'
+SQL_DELETE_WELLS = 'DELETE FROM wells WHERE plate_id=?'
+SQL_INSERT_WELL = ('INSERT INTO wells (plate_id, well, sample, value, category, serum) '
+                   'VALUES (?, ?, ?, ?, ?, ?)')
+SQL_UPDATE_WELL = ('UPDATE wells SET serum=?, category=?, normalized=?, result=? '
+                   'WHERE plate_id=? AND well=?')
+PLATE_COLUMNS = ('well', 'sample', 'value', 'category', 'serum', 'normalized', 'result')
+SQL_SELECT_PLATE = ('SELECT wells.well, wells.sample, wells.value, wells.category, '
+                    'wells.serum, wells.normalized, wells.result '
+                    'FROM wells JOIN plates ON wells.plate_id = plates.id WHERE plates.name=? '
+                    'ORDER BY wells.id')
+WELL_COLUMNS = ('plate', 'well', 'sample', 'value', 'category')
+SQL_SELECT_WELLS = ('SELECT plates.name as plate, wells.well, wells.sample, wells.value, wells.category '
+                    'FROM wells JOIN plates ON wells.plate_id = plates.id ORDER BY wells.id')
+
+# Delimiters accepted between table cells and between well names
+_SPLIT_RE = re.compile(r'[,\s]+')
+# Characters replaced when a plate name is used as a file name
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w.-]+')
+
+_gspread = None
+_gsheet_client = None
+
+
+def ensure_working_directory():
+    """Ensure default working directory exists and switch to it."""
+    target = os.path.join(os.path.expanduser('~'), 'projects', 'ELISA')
+    os.makedirs(target, exist_ok=True)
+    os.chdir(target)
+
+
+def plate_path(plate_name, ext):
+    """Return the export file path for a plate inside PLATES_DIR."""
+    safe = _UNSAFE_FILENAME_RE.sub('_', plate_name).strip('._') or 'plate'
+    # Different names can sanitize to the same text ('a/b' and 'a_b'), so
+    # tag altered names with a short hash of the original. '~' never
+    # survives sanitizing, so a tagged name cannot match an untouched one.
+    if safe != plate_name:
+        safe += '~' + hashlib.sha1(plate_name.encode('utf-8')).hexdigest()[:8]
+    os.makedirs(PLATES_DIR, exist_ok=True)
+    return os.path.join(PLATES_DIR, f'{safe}.{ext}')
+
+
+def save_excel(df, plate_name):
+    """Write df to its own workbook and return the file path.
+
+    Each plate gets a separate file so a save never has to load and
+    re-serialize earlier plates. Rows are streamed to disk with xlsxwriter's
+    constant-memory mode when it is installed, otherwise with openpyxl's
+    write-only workbook; neither builds a styled cell tree.
+    """
+    path = plate_path(plate_name, 'xlsx')
+    sheet_name = os.path.splitext(os.path.basename(path))[0][:31]
+    header = df.columns.tolist()
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    try:
+        import xlsxwriter
+    except ImportError:
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(title=sheet_name)
+        ws.append(header)
+        for row in rows:
+            ws.append(row)
+        wb.save(path)
+    else:
+        wb = xlsxwriter.Workbook(path, {'constant_memory': True})
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, header)
+        for i, row in enumerate(rows, 1):
+            ws.write_row(i, 0, row)
+        wb.close()
+    return path
+
+
+def save_parquet(df, plate_name):
+    """Write df to a compressed Parquet file and return the file path."""
+    path = plate_path(plate_name, 'parquet')
+    df.to_parquet(path, compression='zstd', index=False)
+    return path
+
+
+def export_plate(df, plate_name, fmt=EXPORT_FORMATS[0]):
+    """Export a plate in one of EXPORT_FORMATS and return the file path."""
+    if fmt == 'xlsx':
+        return save_excel(df, plate_name)
+    return save_parquet(df, plate_name)
+
+
+def read_all_plates():
+    """Load every plate exported as Parquet into a single DataFrame."""
+    import pandas as pd
+    paths = sorted(glob(os.path.join(PLATES_DIR, '*.parquet')))
+    if not paths:
+        return pd.DataFrame()
+    return pd.concat((pd.read_parquet(p) for p in paths), ignore_index=True)
+
+
+def connect():
+    """Open a connection to DB_FILE in autocommit mode.
+
+    Writes are grouped explicitly with transaction(); the larger statement
+    cache keeps the prepared statements alive across saves and fetches.
+    """
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False,
+                           cached_statements=256, isolation_level=None)
+    # These settings are per connection, unlike journal_mode which is
+    # stored in the database file by init_db.
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-20000')
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    """Run the enclosed statements in a single BEGIN IMMEDIATE ... COMMIT."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+# Database initialization with category support
+def init_db(conn=None):
+    own_conn = conn is None
+    if own_conn:
+        conn = connect()
+    cur = conn.cursor()
+    # Page layout only takes effect on a fresh database, so these must run
+    # before journal_mode=WAL and the first CREATE TABLE.
+    cur.execute('PRAGMA page_size=8192')
+    cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS plates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS wells (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            plate_id INTEGER,
+            well TEXT,
+            sample TEXT,
+            value REAL,
+            category TEXT,
+            serum TEXT,
+            normalized REAL,
+            result TEXT,
+            FOREIGN KEY(plate_id) REFERENCES plates(id)
+        )
+    ''')
+    # Column and index migrations only need to run once per database
+    if cur.execute('PRAGMA user_version').fetchone()[0] < CURRENT_SCHEMA_VERSION:
+        _migrate(cur)
+    # Return the pages freed by replaced wells since the last start. The
+    # pragma frees one page per step and execute() only steps once, so it
+    # goes through executescript(), which runs it to completion.
+    cur.executescript('PRAGMA incremental_vacuum')
+    if own_conn:
+        conn.close()
+
+
+def _migrate(cur):
+    # Ensure the newer columns exist when upgrading from older versions
+    cur.execute("PRAGMA table_info(wells)")
+    cols = [c[1] for c in cur.fetchall()]
+    if 'category' not in cols:
+        cur.execute('ALTER TABLE wells ADD COLUMN category TEXT')
+    if 'serum' not in cols:
+        cur.execute('ALTER TABLE wells ADD COLUMN serum TEXT')
+    if 'normalized' not in cols:
+        cur.execute('ALTER TABLE wells ADD COLUMN normalized REAL')
+    if 'result' not in cols:
+        cur.execute('ALTER TABLE wells ADD COLUMN result TEXT')
+    # Older versions added a new plate on every save. The newest plate keeps
+    # the name and older ones are renamed to 'name (id)', so their wells and
+    # results stay reachable and saves and fetches see a single plate.
+    older = 'SELECT id FROM plates p WHERE EXISTS (SELECT 1 FROM plates q WHERE q.name = p.name AND q.id > p.id)'
+    cur.execute(f"UPDATE plates SET name = name || ' (' || id || ')' WHERE id IN ({older})")
+    # Indexes for the plate-name lookup, the wells join and the per-well
+    # UPDATE in the results calculation. The old CLI accepted the same well
+    # twice; such plates keep all their rows and get a plain well index.
+    unique = _create_unique_index(cur, 'idx_wells_plate_well', 'wells', 'plate_id, well')
+    # idx_wells_plate_well also serves plate_id lookups on its own
+    cur.execute('DROP INDEX IF EXISTS idx_wells_plate_id')
+    unique &= _create_unique_index(cur, 'idx_plates_name', 'plates', 'name')
+    cur.execute('ANALYZE')
+    # Leave the version alone while an index is not unique, so that the
+    # migration is tried again once the duplicates are gone
+    if unique:
+        cur.execute(f'PRAGMA user_version={CURRENT_SCHEMA_VERSION}')
+
+
+def _create_unique_index(cur, name, table, columns):
+    """Create a unique index, falling back to a plain one on duplicate rows.
+
+    Return True if the index ends up unique. A plain index left by an
+    earlier failed attempt is replaced.
+    """
+    for _, index, is_unique, *_ in cur.execute(f'PRAGMA index_list({table})').fetchall():
+        if index == name and not is_unique:
+            cur.execute(f'DROP INDEX {name}')
+    try:
+        cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table}({columns})')
+    except sqlite3.IntegrityError:
+        cur.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})')
+        return False
+    return True
+
+
+def save_plate(conn, plate_name, wells):
+    """Store a plate, replacing the wells of an existing plate of that name.
+
+    wells is an iterable of (well, sample, value, category, serum) tuples.
+    """
+    # One transaction for the plate and all of its wells: a single commit
+    # instead of one per statement.
+    with transaction(conn):
+        cur = conn.cursor()
+        row = cur.execute(SQL_SELECT_PLATE_ID, (plate_name,)).fetchone()
+        if row:
+            pid = row[0]
+            cur.execute(SQL_DELETE_WELLS, (pid,))
+        else:
+            cur.execute(SQL_INSERT_PLATE, (plate_name,))
+            pid = cur.lastrowid
+        # Rows are generated lazily and consumed one at a time by sqlite3
+        conn.executemany(SQL_INSERT_WELL, ((pid, *w) for w in wells))
+
+
+def fetch_plate(conn, plate_name):
+    """Return the wells of a plate as tuples ordered like PLATE_COLUMNS."""
+    return conn.execute(SQL_SELECT_PLATE, (plate_name,)).fetchall()
+
+
+def load_gspread():
+    """Import gspread on first use; return None if it is not installed."""
+    global _gspread
+    if _gspread is None:
+        try:
+            import gspread
+            import oauth2client.service_account  # noqa: F401
+        except ImportError:
+            gspread = False
+        _gspread = gspread
+    return _gspread or None
+
+
+def get_gsheet_client():
+    global _gsheet_client
+    gspread = load_gspread()
+    if gspread is None:
+        raise RuntimeError('gspread is not installed')
+    # Authorize once per session so the OAuth token exchange is not repeated
+    if _gsheet_client is None:
+        from oauth2client.service_account import ServiceAccountCredentials
+        scope = ['https://spreadsheets.google.com/feeds',
+                 'https://www.googleapis.com/auth/drive']
+        creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS, scope)
+        _gsheet_client = gspread.authorize(creds)
+    return _gsheet_client
+
+
+def upload_gsheet(df, plate_name):
+    """Upload df as a new worksheet of GOOGLE_SHEET_NAME."""
+    from gspread.utils import rowcol_to_a1
+    client = get_gsheet_client()
+    sheet = client.open(GOOGLE_SHEET_NAME)
+    ws = sheet.add_worksheet(title=plate_name, rows=str(len(df)+1), cols=str(len(df.columns)))
+    values = [df.columns.tolist()] + df.fillna('').values.tolist()
+    # The whole plate goes out in one values.update call over an explicit
+    # range; RAW skips server-side parsing of the cell text.
+    ws.update(range_name=f'A1:{rowcol_to_a1(len(values), len(df.columns))}',
+              values=values, value_input_option='RAW')
+
+
+def store_plate(conn, plate_name, wells, df, export_format=None, to_google=False):
+    """Save a plate to the database and optionally to a file and Google Sheets.
+
+    wells is passed to save_plate; df, with a leading 'plate' column, is
+    exported and uploaded. The sinks are independent and mostly wait on disk
+    or network I/O, so they run concurrently. Returns their finished futures
+    as (database, file, sheets), with None for each sink that was skipped.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        db_future = executor.submit(save_plate, conn, plate_name, wells)
+        file_future = executor.submit(export_plate, df, plate_name, export_format) if export_format else None
+        gsheet_future = executor.submit(upload_gsheet, df, plate_name) if to_google and load_gspread() else None
+    return db_future, file_future, gsheet_future
+
+
+def parse_table(text):
+    lines = [l for l in text.strip().splitlines() if l.strip()]
+    # Lines copied from Excel are tab separated and may have empty cells,
+    # so split them on each tab. In other lines commas and runs of
+    # whitespace both separate cells, which str.split handles without the
+    # regex engine.
+    return [l.split('\t') if '\t' in l else l.replace(',', ' ').split() for l in lines]
+
+
+def parse_wells(text):
+    text = text.strip()
+    if not text:
+        return frozenset()
+    return frozenset(w for w in _SPLIT_RE.split(text.upper()) if w)
@@ -1,146 +1,73 @@
+import atexit
 import tkinter as tk
 from tkinter import ttk, messagebox
-import sqlite3
-import os
-import re
-import pandas as pd
-
-try:
-    import gspread
-    from oauth2client.service_account import ServiceAccountCredentials
-except ImportError:
-    gspread = None
-
-DB_FILE = 'elisa.db'
-EXCEL_FILE = 'elisa.xlsx'
-GOOGLE_CREDENTIALS = 'credentials.json'
-GOOGLE_SHEET_NAME = 'ElisaData'
-
-
-def ensure_working_directory():
-    """Ensure default working directory exists and switch to it."""
-    target = os.path.join(os.path.expanduser('~'), 'projects', 'ELISA')
-    os.makedirs(target, exist_ok=True)
-    os.chdir(target)
-
-
-# Database initialization with category support
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS plates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS wells (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            plate_id INTEGER,
-            well TEXT,
-            sample TEXT,
-            value REAL,
-            category TEXT,
-            serum TEXT,
-            normalized REAL,
-            result TEXT,
-            FOREIGN KEY(plate_id) REFERENCES plates(id)
-        )
-    ''')
-    cur.execute("PRAGMA table_info(wells)")
-    cols = [c[1] for c in cur.fetchall()]
-    if 'category' not in cols:
-        cur.execute('ALTER TABLE wells ADD COLUMN category TEXT')
-    if 'serum' not in cols:
-        cur.execute('ALTER TABLE wells ADD COLUMN serum TEXT')
-    if 'normalized' not in cols:
-        cur.execute('ALTER TABLE wells ADD COLUMN normalized REAL')
-    if 'result' not in cols:
-        cur.execute('ALTER TABLE wells ADD COLUMN result TEXT')
-    conn.commit()
-    conn.close()
-
-
-def get_gsheet_client():
-    if gspread is None:
-        raise RuntimeError('gspread is not installed')
-    scope = ['https://spreadsheets.google.com/feeds',
-             'https://www.googleapis.com/auth/drive']
-    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS, scope)
-    client = gspread.authorize(creds)
-    return client
-
-
-def parse_table(text):
-    lines = [l.strip() for l in text.strip().splitlines() if l.strip()]
-    table = [re.split(r'\t|,|\s+', l) for l in lines]
-    return table
-
-
-def parse_wells(text):
-    return set(w.strip().upper() for w in re.split(r'[\s,]+', text) if w.strip())
-
-
-def save_plate_data(wells, plate_name, to_excel=False, to_google=False):
-    if not wells:
+import csv
+import io
+import numpy as np
+
+from elisa_core import (
+    EXPORT_FORMATS,
+    PLATE_COLUMNS,
+    SQL_SELECT_PLATE_ID,
+    SQL_UPDATE_WELL,
+    connect,
+    ensure_working_directory,
+    fetch_plate,
+    init_db,
+    parse_wells,
+    store_plate,
+    transaction,
+)
+
+# Every valid well name (also zero-padded, e.g. A01) mapped to its
+# (row, column) position on the 8x12 plate
+_WELL_TABLE = {
+    f'{chr(65+r)}{col}': (r, c)
+    for r in range(8) for c in range(12) for col in (str(c+1), f'{c+1:02d}')
+}
+
+# Stand-in for wells missing from a fetched plate
+_EMPTY_ROW = (None,) * len(PLATE_COLUMNS)
+
+
+def well_to_rc(well):
+    """Return the (row, column) position of a well name, or None."""
+    return _WELL_TABLE.get(well.upper())
+
+
+def _mask_cells(mask):
+    """Return the (row, column) positions set in an 8x12 boolean mask."""
+    return {tuple(rc) for rc in np.argwhere(mask).tolist()}
+
+
+def save_plate_data(conn, wells, plate_name, export_format=None, to_google=False):
+    if wells.empty:
         messagebox.showwarning('No data', 'Plate is empty')
         return
     if not plate_name:
         messagebox.showwarning('Plate', 'Plate name required')
         return
 
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute('INSERT INTO plates (name) VALUES (?)', (plate_name,))
-    pid = cur.lastrowid
-    cur.executemany(
-        'INSERT INTO wells (plate_id, well, sample, value, category, serum) '
-        'VALUES (?, ?, ?, ?, ?, ?)',
-        [(
-            pid,
-            w['well'],
-            w['sample'],
-            w['value'],
-            w.get('category', ''),
-            w.get('serum', '')
-        ) for w in wells]
-    )
-    conn.commit()
-    conn.close()
-
-    df = pd.DataFrame(wells)
+    df = wells.copy()
     df.insert(0, 'plate', plate_name)
 
-    if to_excel:
-        if os.path.exists(EXCEL_FILE):
-            with pd.ExcelWriter(EXCEL_FILE, mode='a', if_sheet_exists='new', engine='openpyxl') as writer:
-                df.to_excel(writer, sheet_name=plate_name, index=False)
-        else:
-            df.to_excel(EXCEL_FILE, sheet_name=plate_name, index=False)
-
-    if to_google and gspread:
+    # Dialogs are shown from the Tk thread once every sink has finished
+    db_future, file_future, gsheet_future = store_plate(
+        conn, plate_name,
+        wells[['well', 'sample', 'value', 'category', 'serum']].itertuples(index=False, name=None),
+        df, export_format, to_google
+    )
+    db_future.result()
+    if file_future is not None:
+        file_future.result()
+    if gsheet_future is not None:
         try:
-            client = get_gsheet_client()
-            sheet = client.open(GOOGLE_SHEET_NAME)
-            ws = sheet.add_worksheet(title=plate_name, rows=str(len(df)+1), cols=str(len(df.columns)))
-            ws.update([df.columns.tolist()] + df.values.tolist())
+            gsheet_future.result()
         except Exception as e:
             messagebox.showwarning('Google Sheets', f'Upload failed: {e}')
 
     messagebox.showinfo('Saved', f'Plate {plate_name} saved to database.')
 
-def fetch_plate(plate_name):
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query(
-        'SELECT wells.well, wells.sample, wells.value, wells.category, '
-        'wells.serum, wells.normalized, wells.result '
-        'FROM wells JOIN plates ON wells.plate_id = plates.id WHERE plates.name=?',
-        conn, params=(plate_name,))
-    conn.close()
-    return df
-
 
 class App(tk.Tk):
     def __init__(self):
@@ -149,17 +76,29 @@ class App(tk.Tk):
         self.geometry('800x600')
         self.name_cells = {}
         self.value_cells = {}
-        self.categories = {}
+        # The same Entry widgets as flat lists in self._rc_order order
+        self.name_flat = []
+        self.value_flat = []
+        # Per-well state for the 8x12 plate, indexed by (row, column)
+        self.categories = np.full((8, 12), '', dtype=object)
         self.serums = {}
-        self.selected = set()
+        self.selected = np.zeros((8, 12), dtype=bool)
+        self._rendered_bg = {}
+        # Cells waiting for the next idle repaint, and its pending after id
+        self._dirty_colors = set()
+        self._flush_id = None
+        # Set when the category/serum entries must be applied to the plate again
+        self._entries_dirty = True
         self.cat_colors = {
             'K+': '#b6fcb6',
             'K- healthy': '#ffd79f',
             'K- buffer': '#ffb6c1',
             'substrate blank': '#e0e0e0',
         }
+        self.conn = connect()
+        atexit.register(self.conn.close)
         self.build_ui()
-        init_db()
+        init_db(self.conn)
 
     def build_ui(self):
         frm_top = ttk.Frame(self)
@@ -178,6 +117,9 @@ class App(tk.Tk):
 
         rows = [chr(65+i) for i in range(8)]
         cols = [str(i+1) for i in range(12)]
+        # Row-major cell order shared by every per-plate column
+        self._rc_order = [(r, c) for r in range(8) for c in range(12)]
+        self.wells_flat = [f'{rows[r]}{cols[c]}' for r, c in self._rc_order]
 
         for c, col in enumerate(cols):
             ttk.Label(lf_names, text=col).grid(row=0, column=c+1)
@@ -193,6 +135,8 @@ class App(tk.Tk):
                 e_value.grid(row=r+1, column=c+1, padx=1, pady=1)
                 self.name_cells[(r, c)] = e_name
                 self.value_cells[(r, c)] = e_value
+                self.name_flat.append(e_name)
+                self.value_flat.append(e_value)
                 e_name.bind('<Button-1>', lambda e, rc=(r, c): self.toggle_select(rc))
                 e_value.bind('<Button-1>', lambda e, rc=(r, c): self.toggle_select(rc))
 
@@ -209,22 +153,25 @@ class App(tk.Tk):
             ('substrate blank', 'Substrate blank:')
         ]
         self.cat_entries = {}
+        self._entry_vars = []
         for i, (cat, text) in enumerate(labels):
             ttk.Label(frm_cat, text=text).grid(row=i, column=0, sticky='e')
-            ent = ttk.Entry(frm_cat)
+            ent = ttk.Entry(frm_cat, textvariable=self._watched_var())
             ent.grid(row=i, column=1, sticky='ew', padx=2)
             ttk.Button(frm_cat, text='Set selected', command=lambda c=cat: self.assign_selected(c)).grid(row=i, column=2, padx=2)
             self.cat_entries[cat] = ent
         ttk.Label(frm_cat, text='Serum name:').grid(row=len(labels), column=0, sticky='e')
-        self.entry_serum = ttk.Entry(frm_cat)
+        self.entry_serum = ttk.Entry(frm_cat, textvariable=self._watched_var())
         self.entry_serum.grid(row=len(labels), column=1, sticky='ew', padx=2)
         frm_cat.columnconfigure(1, weight=1)
 
         frm_opts = ttk.Frame(self)
         frm_opts.pack(fill='x', pady=5)
-        self.var_excel = tk.BooleanVar(value=False)
+        self.var_file = tk.BooleanVar(value=False)
+        self.var_format = tk.StringVar(value=EXPORT_FORMATS[0])
         self.var_google = tk.BooleanVar(value=False)
-        ttk.Checkbutton(frm_opts, text='Save to Excel', variable=self.var_excel).pack(side='left', padx=5)
+        ttk.Checkbutton(frm_opts, text='Save to file', variable=self.var_file).pack(side='left', padx=5)
+        ttk.Combobox(frm_opts, textvariable=self.var_format, values=EXPORT_FORMATS, width=8, state='readonly').pack(side='left')
         ttk.Checkbutton(frm_opts, text='Save to Google Sheets', variable=self.var_google).pack(side='left', padx=5)
 
         frm_btn = ttk.Frame(self)
@@ -247,103 +194,134 @@ class App(tk.Tk):
         self.text_output = tk.Text(self, height=10)
         self.text_output.pack(fill='both', expand=True, padx=5, pady=5)
 
-    def well_to_rc(self, well):
-        m = re.match(r'^([A-H])(\d{1,2})$', well.upper())
-        if not m:
-            return None
-        r = ord(m.group(1)) - 65
-        c = int(m.group(2)) - 1
-        if 0 <= r < 8 and 0 <= c < 12:
-            return r, c
-        return None
+    def _watched_var(self):
+        var = tk.StringVar(self)
+        var.trace_add('write', self._mark_entries_dirty)
+        self._entry_vars.append(var)
+        return var
 
-    def _update_cell_color(self, rc):
-        color = self.cat_colors.get(self.categories.get(rc, ''), 'white')
+    def _mark_entries_dirty(self, *_):
+        self._entries_dirty = True
+
+    def _set_cell_bg(self, rc, color):
+        # Restyling an Entry is the expensive part of a click; skip it when
+        # the cell already shows the requested color.
+        if self._rendered_bg.get(rc) == color:
+            return
         self.name_cells[rc].config(bg=color)
         self.value_cells[rc].config(bg=color)
+        self._rendered_bg[rc] = color
+
+    def _update_cell_color(self, rc):
+        self._update_cell_colors((rc,))
+
+    def _update_cell_colors(self, rcs):
+        # Cells are only marked here and repainted together once Tk is idle,
+        # so each one is reconfigured once however often it changed.
+        self._dirty_colors.update(rcs)
+        if self._flush_id is None and self._dirty_colors:
+            self._flush_id = self.after_idle(self._flush_colors)
+
+    def _flush_colors(self):
+        self._flush_id = None
+        dirty, self._dirty_colors = self._dirty_colors, set()
+        for rc in dirty:
+            if self.selected[rc]:
+                self._set_cell_bg(rc, 'cyan')
+            else:
+                self._set_cell_bg(rc, self.cat_colors.get(self.categories[rc], 'white'))
 
     def toggle_select(self, rc):
-        if rc in self.selected:
-            self.selected.remove(rc)
-            self._update_cell_color(rc)
-        else:
-            self.selected.add(rc)
-            self.name_cells[rc].config(bg='cyan')
-            self.value_cells[rc].config(bg='cyan')
+        self.selected[rc] = not self.selected[rc]
+        self._update_cell_color(rc)
 
     def assign_selected(self, cat):
         serum = self.entry_serum.get().strip()
-        for rc in list(self.selected):
+        changed = _mask_cells(self.selected)
+        self.selected[:] = False
+        for w in parse_wells(self.cat_entries[cat].get()):
+            rc = well_to_rc(w)
+            if rc:
+                changed.add(rc)
+        for rc in changed:
             self.categories[rc] = cat
             if serum:
                 self.serums[rc] = serum
-            self.selected.remove(rc)
-            self._update_cell_color(rc)
-        for w in parse_wells(self.cat_entries[cat].get()):
-            rc = self.well_to_rc(w)
-            if rc:
-                self.categories[rc] = cat
-                if serum:
-                    self.serums[rc] = serum
-                self._update_cell_color(rc)
+        self._entries_dirty = True
+        self._update_cell_colors(changed)
 
     def clear_selection(self):
-        for rc in list(self.selected):
-            self.selected.remove(rc)
+        changed = _mask_cells(self.selected)
+        self.selected[:] = False
+        for rc in changed:
             self.serums.pop(rc, None)
-            self._update_cell_color(rc)
+        self._entries_dirty = True
+        self._update_cell_colors(changed)
 
     def assign_from_entries(self):
+        # Nothing to re-parse if neither the entries nor the plate changed
+        # since they were last applied.
+        if not self._entries_dirty:
+            return
+        self._entries_dirty = False
         serum = self.entry_serum.get().strip()
+        changed = set()
         for cat, ent in self.cat_entries.items():
             for w in parse_wells(ent.get()):
-                rc = self.well_to_rc(w)
+                rc = well_to_rc(w)
                 if rc:
                     self.categories[rc] = cat
                     if serum:
                         self.serums[rc] = serum
-                    self._update_cell_color(rc)
+                    changed.add(rc)
+        self._update_cell_colors(changed)
 
     def paste_clipboard(self, target):
         try:
             text = self.clipboard_get()
         except tk.TclError:
             return
-        rows = text.strip().splitlines()
-        for r, line in enumerate(rows):
+        text = text.strip()
+        if not text:
+            return
+        cells = self.name_flat if target == 'names' else self.value_flat
+        # Excel puts tab-separated text on the clipboard; csv.reader splits
+        # it in C and also copes with quoted cells.
+        reader = csv.reader(io.StringIO(text), delimiter='\t')
+        for r, row in enumerate(reader):
             if r >= 8:
                 break
-            cells = re.split(r'\t', line)
-            for c, cell in enumerate(cells):
-                if c >= 12:
-                    break
-                widget = self.name_cells[(r, c)] if target == 'names' else self.value_cells[(r, c)]
-                widget.delete(0, 'end')
-                widget.insert(0, cell.strip())
+            for c, cell in enumerate(row[:12]):
+                # _set_entry leaves cells that already hold this text alone
+                self._set_entry(cells[r * 12 + c], cell.strip())
+
+    @staticmethod
+    def _set_entry(widget, text):
+        # Skip the delete/insert round-trip when the text is unchanged
+        if widget.get() != text:
+            widget.delete(0, 'end')
+            widget.insert(0, text)
 
     def collect_data(self):
-        wells = []
-        for r in range(8):
-            for c in range(12):
-                well = f"{chr(65+r)}{c+1}"
-                name = self.name_cells[(r, c)].get().strip()
-                val_text = self.value_cells[(r, c)].get().strip()
-                try:
-                    value = float(val_text) if val_text else None
-                except ValueError:
-                    value = None
-                cat = self.categories.get((r, c), '')
-                serum = self.serums.get((r, c), '')
-                wells.append({'well': well, 'sample': name, 'value': value, 'category': cat, 'serum': serum})
-        return wells
+        import pandas as pd
+        values = [e.get().strip() for e in self.value_flat]
+        # Unparseable or empty values become NaN (stored as NULL)
+        return pd.DataFrame({
+            'well': self.wells_flat,
+            'sample': [e.get().strip() for e in self.name_flat],
+            'value': pd.to_numeric(pd.Series(values), errors='coerce').astype(float),
+            'category': self.categories.flatten(),
+            'serum': [self.serums.get(rc, '') for rc in self._rc_order],
+        })
 
     def save(self):
         self.assign_from_entries()
         wells = self.collect_data()
         save_plate_data(
+            self.conn,
             wells,
             self.entry_plate.get().strip(),
-            self.var_excel.get(),
+            self.var_format.get() if self.var_file.get() else None,
             self.var_google.get()
         )
 
@@ -352,50 +330,54 @@ class App(tk.Tk):
         if not plate:
             messagebox.showwarning('Plate', 'Enter plate name to fetch')
             return
-        df = fetch_plate(plate)
+        rows = fetch_plate(self.conn, plate)
         self.text_output.delete('1.0', 'end')
-        for rc in list(self.categories):
-            self.categories.pop(rc, None)
-            self._update_cell_color(rc)
-        for r in range(8):
-            for c in range(12):
-                self.name_cells[(r, c)].delete(0, 'end')
-                self.value_cells[(r, c)].delete(0, 'end')
-        if df.empty:
+        changed = _mask_cells(self.categories != '')
+        self.categories[:] = ''
+        by_rc = {}
+        for row in rows:
+            rc = well_to_rc(row[0])
+            if rc:
+                by_rc[rc] = row
+        # Write each cell once with its final text instead of clearing the
+        # whole grid and refilling it.
+        for rc, e_name, e_value in zip(self._rc_order, self.name_flat, self.value_flat):
+            _, sample, value, category, serum, _, _ = by_rc.get(rc, _EMPTY_ROW)
+            self._set_entry(e_name, sample or '')
+            self._set_entry(e_value, '' if value is None else str(value))
+            if category:
+                self.categories[rc] = category
+                changed.add(rc)
+            if serum:
+                self.serums[rc] = serum
+        self._entries_dirty = True
+        self._update_cell_colors(changed)
+        if not rows:
             self.text_output.insert('end', 'No data found\n')
             return
-        for _, row in df.iterrows():
-            rc = self.well_to_rc(row['well'])
-            if not rc:
-                continue
-            r, c = rc
-            self.name_cells[(r, c)].insert(0, str(row['sample']))
-            if row['value'] is not None:
-                self.value_cells[(r, c)].insert(0, str(row['value']))
-            if row['category']:
-                self.categories[(r, c)] = row['category']
-                self._update_cell_color((r, c))
-            if row['serum']:
-                self.serums[(r, c)] = row['serum']
-        self.text_output.insert('end', df.to_string(index=False))
-        if df.empty:
-            self.text_output.insert('end', 'No data found\n')
-        else:
-            self.text_output.insert('end', df.to_string(index=False))
+        self._show_rows(PLATE_COLUMNS, rows)
+
+    def _show_rows(self, columns, rows):
+        # Stream rows into the output box instead of formatting the whole
+        # table into one string first.
+        self.text_output.insert('end', '\t'.join(columns) + '\n')
+        for row in rows:
+            self.text_output.insert('end', '\t'.join('' if v is None else str(v) for v in row) + '\n')
 
     def calculate_results(self):
         self.assign_from_entries()
-        wells = self.collect_data()
-        df = pd.DataFrame(wells)
+        df = self.collect_data()
         if df['value'].dropna().empty:
             messagebox.showwarning('Data', 'No numeric values to analyze')
             return
 
-        blank_vals = df[df['category'] == 'substrate blank']['value'].dropna()
-        blank = blank_vals.mean() if not blank_vals.empty else 0.0
-        df['normalized'] = df['value'] - blank
+        blank = df.loc[df['category'].eq('substrate blank'), 'value'].mean()
+        if np.isnan(blank):
+            blank = 0.0
+        normalized = df['value'].to_numpy() - blank
+        df['normalized'] = normalized
 
-        healthy = df[df['category'] == 'K- healthy']['normalized'].dropna()
+        healthy = df.loc[df['category'].eq('K- healthy'), 'normalized'].dropna()
         if healthy.empty:
             messagebox.showwarning('Controls', 'No healthy sap values provided')
             return
@@ -408,25 +390,21 @@ class App(tk.Tk):
             threshold = mean_h + mult * healthy.std()
         else:
             threshold = mean_h * mult
-        df['result'] = df['normalized'].apply(lambda x: 'positive' if x > threshold else 'negative')
+        # Wells without a value get 'unknown' instead of being called negative
+        df['result'] = np.where(np.isnan(normalized), 'unknown',
+                                np.where(normalized > threshold, 'positive', 'negative'))
 
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute('SELECT id FROM plates WHERE name=?', (self.entry_plate.get().strip(),))
-        row = cur.fetchone()
+        row = self.conn.execute(SQL_SELECT_PLATE_ID, (self.entry_plate.get().strip(),)).fetchone()
         if row:
-            pid = row[0]
-            for _, r in df.iterrows():
-                cur.execute(
-                    'UPDATE wells SET serum=?, category=?, normalized=?, result=? '
-                    'WHERE plate_id=? AND well=?',
-                    (r.get('serum', ''), r['category'], r['normalized'], r['result'], pid, r['well'])
-                )
-            conn.commit()
-        conn.close()
+            # One prepared UPDATE bound once per well, all in one transaction
+            params = zip(df['serum'], df['category'], df['normalized'], df['result'],
+                         [row[0]] * len(df), df['well'])
+            with transaction(self.conn):
+                self.conn.executemany(SQL_UPDATE_WELL, params)
 
         self.text_output.delete('1.0', 'end')
-        self.text_output.insert('end', df[["well", "sample", "serum", "normalized", "result"]].to_string(index=False))
+        columns = ["well", "sample", "serum", "normalized", "result"]
+        self._show_rows(columns, df[columns].itertuples(index=False, name=None))
 
 
 if __name__ == '__main__':